@@ -4,6 +4,15 @@ import biome.load.genbank.genbank as gb
 import os
 import warnings
 import logging
+import multiprocessing
+import cProfile
+import functools
+import json
+import urllib2
+import traceback
+
+# number of entities sent to the database in one request
+BATCH_SIZE = 500
 
 
 def update_source_property(node):
@@ -31,13 +40,91 @@ def tf_effect(effect):
         return 'UNKNOWN'
 
 
+def partition_rows(rows, key, partitions):
+    """
+    Splits rows into at most `partitions` groups. Rows with the same key
+    always end up in the same group, so a key must cover all nodes a row
+    can touch.
+    """
+    if not isinstance(partitions, int) or partitions < 1:
+        raise ValueError('The partitions argument must be a positive integer!')
+    keys = {}
+    for row in rows:
+        keys.setdefault(key(row), []).append(row)
+    groups = [[] for i in range(partitions)]
+
+    # the largest keys go first to keep the groups balanced
+    for key_rows in sorted(keys.values(), key=len, reverse=True):
+        min(groups, key=len).extend(key_rows)
+    return [group for group in groups if group]
+
+
+def _run_partition(task):
+    """
+    Writes one partition of a stage in a worker process with its own
+    connection. Returns the stage counters, the deferred relations and an
+    error message, which is None if the partition was written.
+    """
+    settings, stage, index, rows, extra = task
+    deferred = []
+    loader = None
+    try:
+        loader = RegulonDB(**settings)
+        if loader.profile_path is None:
+            counts = getattr(loader, stage)(rows, deferred=deferred, **extra)
+        else:
+            # a pool process can write several partitions
+            name = '%s.partition%d' % (stage.lstrip('_'), index)
+            counts = _profile_call(loader, name, getattr(loader, stage), rows,
+                                   deferred=deferred, **extra)
+    # the relations of the nodes created before a failure are still
+    # returned, so that the serial pass does not leave them orphaned
+    except Exception:
+        error = traceback.format_exc()
+
+        # sending the statements queued for the rows written before
+        if loader is not None:
+            try:
+                loader._flush()
+            except Exception:
+                error += 'The queued statements were not sent:\n%s' \
+                         % traceback.format_exc()
+        return [0, 0, 0], deferred, error
+    return counts, deferred, None
+
+
+def _profile_call(loader, name, func, *args, **kwargs):
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        profile.dump_stats('%s%s.pstats' % (loader.profile_path, name))
+        loader._dump_plans(name)
+
+
+def profiled(stage):
+    """
+    Runs a stage under cProfile if the loader has a profile_path. The
+    statistics are saved to <profile_path><stage>.pstats and the plans of
+    the queries first run by the stage to <profile_path><stage>.plans.json.
+    """
+    @functools.wraps(stage)
+    def wrapper(self, *args, **kwargs):
+        if self.profile_path is None:
+            return stage(self, *args, **kwargs)
+        return _profile_call(self, stage.__name__, stage, self,
+                             *args, **kwargs)
+    return wrapper
+
+
 class RegulonDB():
     """
 
     """
     def __init__(self, directory, ecoli_name='Escherichia coli str. K-12 substr. MG1655',
                  chro_name='Escherichia coli str. K-12 substr. MG1655, complete genome.',
-                 dblink='http://localhost:7474/db/data/', log_path='./'):
+                 dblink='http://localhost:7474/db/data/', log_path='./',
+                 idempotent=False, profile_path=None, create_schema=True):
         if not isinstance(ecoli_name, basestring):
             raise TypeError('The ecoli_name argument must be a string!')
         if not isinstance(dblink, basestring):
@@ -51,6 +138,16 @@ class RegulonDB():
         self.log_path=log_path
         self.connection = neo4j.GraphDatabaseService(self.dblink)
 
+        # if True, relations and regulation events are merged on
+        # RegulonDB IDs and natural keys, so reruns do not grow the graph
+        self.idempotent = idempotent
+        self._statements = []
+
+        # if not None, stages are profiled and query plans are saved there
+        self.profile_path = profile_path
+        self._templates = set()
+        self._plans = []
+
         logging.basicConfig(filename='%sregulondb.log' % self.log_path,
                             level=logging.INFO,
                             format='%(asctime)s - %(levelname)s - %(message)s',
@@ -75,6 +172,14 @@ class RegulonDB():
             raise ValueError('There is no chromosome node with %s name!' % self.chro_name)
         self.chro_node = chro_node[0]
 
+        # nodes shared by all partitions of a stage
+        self.hubs = {'organism': self.ecoli_node,
+                     'chromosome': self.chro_node}
+
+        # partition workers rely on the schema created by their parent
+        if self.idempotent and create_schema:
+            self._create_constraints()
+
     def __repr__(self):
         return "RegulonDB object for %s\nLink to database: %s" \
                % (self.ecoli_name, self.dblink)
@@ -86,18 +191,321 @@ class RegulonDB():
     def check_create_terms(self, bioentity, name):
         if not isinstance(bioentity, gb.neo4j.Node):
             raise TypeError('The node argument must be an object of neo4j.Node class!')
-        if bioentity['name'] != name:
+        if bioentity['name'] != name and self.idempotent:
+            query = 'START b=node({bioentity}) ' \
+                    'MERGE (b)-[:HAS_NAME]->(t:Term {text: {name}})'
+            self._queue(query, {'bioentity': bioentity._id, 'name': name})
+        elif bioentity['name'] != name:
             term, rel_pro = self.connection.create(
                 node({'text': name}),
                 rel(0, 'HAS_NAME', bioentity))
             term.add_labels('Term')
 
+    def _create_constraints(self):
+        """
+        Creates unique constraints for the keys of the merged nodes, so that
+        a MERGE is an index lookup and stays unique across partition
+        workers. Creating an existing constraint has no effect.
+        """
+        for label in ['TranscriptionRegulation', 'RBS', 'TU']:
+            query = 'CREATE CONSTRAINT ON (n:%s) ASSERT n.Reg_id IS UNIQUE' \
+                    % label
+            try:
+                neo4j.CypherQuery(self.connection, query).run()
+            except neo4j.CypherError:
+                # there are duplicates from a non-idempotent load
+                logging.warning("Could not create a unique constraint for "
+                                "%s nodes! An index was created instead."
+                                % label)
+                query = 'CREATE INDEX ON :%s(Reg_id)' % label
+                neo4j.CypherQuery(self.connection, query).run()
+
+        # operons are merged on their names
+        query = 'CREATE INDEX ON :Operon(name)'
+        neo4j.CypherQuery(self.connection, query).run()
+
+    def _execute(self, template, args=(), **params):
+        """
+        Runs a read query built as template % args with Cypher parameters.
+        In the profiling mode every distinct template is also run once with
+        PROFILE and its plan is kept for the stage plans dump.
+        """
+        query = template % args if args else template
+        if self.profile_path is not None and template not in self._templates:
+            self._templates.add(template)
+            self._profile_query(template, query, params)
+        res = neo4j.CypherQuery(self.connection, query)
+        return res.execute(**params)
+
+    def _execute_write(self, query, **params):
+        """
+        Runs a write statement whose results a stage needs at once. In the
+        profiling mode it is profiled once like the queued statements.
+        """
+        res = neo4j.CypherQuery(self.connection, query)
+        res_nodes = res.execute(**params)
+        if self.profile_path is not None and query not in self._templates:
+            self._templates.add(query)
+            self._profile_write(query, params)
+        return res_nodes
+
+    def _profile_query(self, template, query, params):
+        request = urllib2.Request(self.dblink + 'cypher?profile=true',
+                                  json.dumps({'query': query,
+                                              'params': params}),
+                                  {'Content-Type': 'application/json',
+                                   'Accept': 'application/json'})
+        try:
+            plan = json.load(urllib2.urlopen(request))['plan']
+        except (urllib2.URLError, ValueError, KeyError):
+            logging.warning("Could not profile a query: %s" % query)
+            return
+        self._keep_plan(template, query, params, plan)
+
+    def _profile_write(self, query, params):
+        """
+        Runs a write statement with PROFILE in a transaction that is rolled
+        back, so the plan is kept without changing the graph.
+        """
+        body = {'statements': [{'statement': 'PROFILE ' + query,
+                                'parameters': params}]}
+        request = urllib2.Request(self.dblink + 'transaction', json.dumps(body),
+                                  {'Content-Type': 'application/json',
+                                   'Accept': 'application/json'})
+        plan, transaction = None, None
+        try:
+            response = urllib2.urlopen(request)
+            transaction = response.info().getheader('Location')
+            result = json.load(response)
+            if result.get('errors'):
+                # the server has rolled back a failed transaction itself
+                transaction = None
+            elif transaction is None and 'commit' in result:
+                transaction = result['commit'][:-len('/commit')]
+            plan = result['results'][0]['plan']
+        except (urllib2.URLError, ValueError, KeyError, IndexError):
+            pass
+        finally:
+            if transaction is not None:
+                self._rollback(transaction)
+
+        if plan is None:
+            logging.warning("Could not profile a write query, it was left "
+                            "unprofiled: %s" % query)
+            return
+        self._keep_plan(query, query, params, plan.get('root', plan))
+
+    def _rollback(self, transaction):
+        rollback = urllib2.Request(transaction)
+        rollback.get_method = lambda: 'DELETE'
+        try:
+            urllib2.urlopen(rollback)
+        except urllib2.URLError:
+            logging.error("Could not roll back the profiling transaction %s! "
+                          "It keeps its locks until the server times it out."
+                          % transaction)
+
+    def _keep_plan(self, template, query, params, plan):
+        def db_hits(step):
+            return step.get('dbHits', 0) + \
+                   sum([db_hits(child) for child in step.get('children', [])])
+
+        self._plans.append({'template': template, 'query': query,
+                            'params': params, 'db_hits': db_hits(plan),
+                            'plan': plan})
+
+    def _dump_plans(self, name):
+        plans = sorted(self._plans, key=lambda plan: plan['db_hits'],
+                       reverse=True)
+        self._plans = []
+        f = open('%s%s.plans.json' % (self.profile_path, name), 'w')
+        json.dump(plans, f, indent=2)
+        f.close()
+        logging.info('%d query plans of %s were saved!' % (len(plans), name))
+
+    def _read_lines(self, filename):
+        f = open(self.directory + filename, 'r')
+        data = f.readlines()
+        f.close()
+        return [line for line in data if line[0] != '#']
+
+    def _create(self, abstracts, part_of, deferred=None):
+        """
+        Creates abstracts in one request together with PART_OF relations
+        with hub nodes. part_of is a list of (index, hub) pairs, where index
+        points to a created entity. If deferred is a list, the hub relations
+        are appended to it instead of being created.
+        """
+        abstracts = list(abstracts)
+        if deferred is None:
+            abstracts += [rel(i, 'PART_OF', self.hubs[hub])
+                          for i, hub in part_of]
+        entities = self.connection.create(*abstracts)
+        if deferred is not None:
+            deferred.extend([('PART_OF', entities[i]._id, hub)
+                             for i, hub in part_of])
+        return entities
+
+    def _tf_registry(self, rows):
+        """
+        Resolves or creates protein nodes for all distinct regulators of
+        binding sites at once. Returns a dictionary with Reg_ids as keys and
+        protein nodes as values; regulators with duplicated nodes map to None.
+        """
+        names = {}
+        for row in rows:
+            if self._valid_bs_row(row):
+                names.setdefault(row[0], row[1])
+
+        query = 'MATCH (p:Protein) WHERE p.Reg_id IN {regids} ' \
+                'RETURN p.Reg_id, p'
+        res_nodes = self._execute(query, regids=list(names))
+        found = {}
+        for record in res_nodes.data:
+            found.setdefault(record.values[0], []).append(record.values[1])
+
+        registry = {}
+        for regid, protein_node in found.items():
+            # if there are proteins-duplicates
+            if len(protein_node) > 1:
+                logging.warning("There are %d nodes for a protein with name %s!"
+                                "They were skipped!"
+                                % (len(protein_node), names[regid]))
+                registry[regid] = None
+            else:
+                registry[regid] = protein_node[0]
+
+        # creating missing proteins
+        missing = [regid for regid in names if regid not in found]
+        for i in range(0, len(missing), BATCH_SIZE):
+            chunk = missing[i:i + BATCH_SIZE]
+            proteins = self.connection.create(
+                *[node({'Reg_id': regid, 'name': names[regid],
+                        'source': 'RegulonDB'}) for regid in chunk])
+            query = 'START p=node({ids}) SET p:Protein:BioEntity'
+            self._queue(query, {'ids': [protein._id for protein in proteins]})
+            registry.update(zip(chunk, proteins))
+        self._flush()
+
+        logging.info('%d TFs were found, %d TFs were created!'
+                     % (len(found), len(missing)))
+        return registry
+
+    def _link_proteins(self, registry, links):
+        """
+        Creates (:Protein)-[:PARTICIPATES_IN]->(:TranscriptionRegulation)
+        relations for (regid, transreg) pairs in batches.
+        """
+        linked = 0
+        for regid, transreg in links:
+            if registry.get(regid) is not None:
+                self._participates(registry[regid], transreg)
+                linked += 1
+        self._flush()
+        return linked
+
+    def _run_partitioned(self, stage, rows, key, workers, extra,
+                         registry=None):
+        """
+        Splits rows by key and writes every partition by a separate worker
+        process. Relations between partitions (hub nodes, proteins) are
+        created afterwards in a serial pass. Returns the summed counters.
+        """
+        settings = {'directory': self.directory,
+                    'ecoli_name': self.ecoli_name,
+                    'chro_name': self.chro_name,
+                    'dblink': self.dblink,
+                    'log_path': self.log_path,
+                    'idempotent': self.idempotent,
+                    'profile_path': self.profile_path,
+                    'create_schema': False}
+        tasks = [(settings, stage, index, part, extra) for index, part
+                 in enumerate(partition_rows(rows, key, workers))]
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_run_partition, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        self._link_deferred([d for r in results for d in r[1]], registry)
+
+        errors = [r[2] for r in results if r[2] is not None]
+        if errors:
+            for error in errors:
+                logging.error('A partition of %s failed:\n%s' % (stage, error))
+            raise Exception('%d of %d partitions of %s failed!'
+                            % (len(errors), len(tasks), stage))
+        logging.info('%d partitions were written by %d workers!'
+                     % (len(tasks), workers))
+
+        totals = [sum(c) for c in zip(*[r[0] for r in results])]
+        return totals or [0, 0, 0]
+
+    def _link_deferred(self, deferred, registry=None):
+        linked, links = 0, []
+        for rel_type, start, end in deferred:
+            if rel_type == 'PART_OF':
+                self._relate(self.connection.node(start), 'PART_OF',
+                             self.hubs[end])
+                linked += 1
+            else:
+                links.append((start, end))
+        self._flush()
+        if links:
+            linked += self._link_proteins(registry, links)
+        logging.info('%d deferred relations were linked!' % linked)
+
+    def _queue(self, query, params):
+        self._statements.append((query, params))
+        if len(self._statements) >= BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        """
+        Sends the queued statements to the database in one request.
+        """
+        if not self._statements:
+            return
+        batch = neo4j.WriteBatch(self.connection)
+        for query, params in self._statements:
+            batch.append_cypher(query, params)
+        batch.submit()
+
+        # write templates are profiled once the earlier statements
+        # they depend on are in the database
+        if self.profile_path is not None:
+            for query, params in self._statements:
+                if query not in self._templates:
+                    self._templates.add(query)
+                    self._profile_write(query, params)
+        self._statements = []
+
+    def _relate(self, start, rel_type, end):
+        """
+        Queues a (start)-[:rel_type]->(end) relation. In the idempotent
+        mode the relation is merged, so it is created only once.
+        """
+        query = 'START a=node({a}), b=node({b}) %s (a)-[:%s]->(b)' \
+                % ('MERGE' if self.idempotent else 'CREATE', rel_type)
+        self._queue(query, {'a': start._id, 'b': end._id})
+
+    def _participates(self, protein_node, transreg):
+        # in the idempotent mode regulation events are keyed on Reg_id
+        if self.idempotent:
+            query = 'START pr=node({protein}) ' \
+                    'MATCH (tr:TranscriptionRegulation {Reg_id: {regid}}) ' \
+                    'MERGE (pr)-[:PARTICIPATES_IN]->(tr)'
+            self._queue(query, {'protein': protein_node._id,
+                                'regid': transreg})
+        else:
+            self._relate(protein_node, 'PARTICIPATES_IN',
+                         self.connection.node(transreg))
+
     def relation_with_tu(self, tu_name, element):
         query = 'MATCH (o:Organism {name: "%s"})<-[:PART_OF]-' \
                     '(tu:TU)-[:HAS_NAME]->(:Term {text: "%s"}) ' \
-                    'RETURN tu' % (self.ecoli_name, tu_name)
-        res = neo4j.CypherQuery(self.connection, query)
-        res_nodes = res.execute()
+                    'RETURN tu'
+        res_nodes = self._execute(query, (self.ecoli_name, tu_name))
 
         if not res_nodes:
             logging.warning("There is no node for a TU with name %s!"
@@ -105,10 +513,10 @@ class RegulonDB():
             return 1
         else:
             for tu in res_nodes.data:
-                rel_tu = self.connection.create(
-                    rel(tu.values[0], 'CONTAINS', element))
+                self._relate(tu.values[0], 'CONTAINS', element)
             return 0
 
+    @profiled
     def create_operons(self):
         f = open(self.directory + 'Operons.txt', 'r')
         data = f.readlines()
@@ -125,17 +533,33 @@ class RegulonDB():
             if chunks[3] == '':
                 chunks[3] = 'unknown'
 
-            operon, term, term_rel, org_rel = self.connection.\
-                create(node({'name': chunks[0], 'start': int(chunks[1]),
-                             'end': int(chunks[2]), 'strand': chunks[3],
-                             'evidence': chunks[6], 'source': 'RegulonDB'}),
-                       node({'text': chunks[0]}),
-                       rel(0, 'HAS_NAME', 1),
-                       rel(0, 'PART_OF', self.ecoli_node))
-            operon.add_labels('Operon', 'BioEntity', 'DNA')
+            properties = {'name': chunks[0], 'start': int(chunks[1]),
+                          'end': int(chunks[2]), 'strand': chunks[3],
+                          'evidence': chunks[6], 'source': 'RegulonDB'}
+
+            if self.idempotent:
+                query = 'START o=node({organism}) ' \
+                        'MERGE (op:Operon {name: {name}}) ' \
+                        'ON CREATE SET op = {properties}, op:BioEntity:DNA ' \
+                        'MERGE (op)-[:HAS_NAME]->(t {text: {name}}) ' \
+                        'MERGE (op)-[:PART_OF]->(o)'
+                self._queue(query, {'organism': self.ecoli_node._id,
+                                    'name': chunks[0],
+                                    'properties': properties})
+            else:
+                operon, term, term_rel, org_rel = self.connection.\
+                    create(node(properties),
+                           node({'text': chunks[0]}),
+                           rel(0, 'HAS_NAME', 1),
+                           rel(0, 'PART_OF', self.ecoli_node))
+                operon.add_labels('Operon', 'BioEntity', 'DNA')
             i += 1
-        logging.info('%d operons were created!' % i)
 
+        self._flush()
+        logging.info('%d operons were %s!'
+                     % (i, 'merged' if self.idempotent else 'created'))
+
+    @profiled
     def create_update_promoters(self):
         f = open(self.directory + 'All Promoters.txt', 'r')
         data = f.readlines()
@@ -155,9 +579,9 @@ class RegulonDB():
             query = 'MATCH (ch:Chromosome {name: "%s"})<-[:PART_OF]-' \
                     '(p:Promoter {tss: %d})-[:PART_OF]->' \
                     '(o:Organism {name: "%s"}) ' \
-                    'RETURN p' % (self.chro_name, tss,  self.ecoli_name)
-            res = neo4j.CypherQuery(self.connection, query)
-            res_nodes = res.execute()
+                    'RETURN p'
+            res_nodes = self._execute(query,
+                                      (self.chro_name, tss, self.ecoli_name))
 
             # creating promoter
             if not res_nodes:
@@ -191,9 +615,11 @@ class RegulonDB():
                                      "tss in the %d position! It was skipped!"
                                      % (len(res_nodes.data), tss))
 
+        self._flush()
         logging.info("%d promoters were updated!" % updated)
         logging.info("%d promoters were created!" % created)
 
+    @profiled
     def create_update_tus(self):
         f = open(self.directory + 'Transcription Units.txt', 'r')
         data = f.readlines()
@@ -212,28 +638,50 @@ class RegulonDB():
             query = 'MATCH (t:Term {text: "%s"})<-[:HAS_NAME]-' \
                     '(p:Promoter)<-[:CONTAINS]-(tu:TU)-[:PART_OF]->' \
                     '(o:Organism {name: "%s"}) ' \
-                    'RETURN tu' % (pro, self.ecoli_name)
-            res = neo4j.CypherQuery(self.connection, query)
-            res_nodes = res.execute()
+                    'RETURN tu'
+            res_nodes = self._execute(query, (pro, self.ecoli_name))
 
             # no tu with the name was found
             if not res_nodes:
-                tu, term, rel_org, rel_term = self.connection.create(
-                    node({'name': name, 'evidence': evidence,
-                          'Reg_id': regid, 'source': 'RegulonDB'}),
-                    node({'text': name}),
-                    rel(0, 'PART_OF', self.ecoli_node),
-                    rel(0, 'HAS_NAME', 1))
-                tu.add_labels('TU', 'BioEntity', 'DNA')
-                term.add_labels('Term')
+                properties = {'name': name, 'evidence': evidence,
+                              'Reg_id': regid, 'source': 'RegulonDB'}
+
+                # TUs without a promoter node can be found only by their
+                # RegulonDB IDs
+                if self.idempotent:
+                    query = 'START o=node({organism}) ' \
+                            'MERGE (tu:TU {Reg_id: {regid}}) ' \
+                            'ON CREATE SET tu = {properties}, ' \
+                            'tu:BioEntity:DNA ' \
+                            'MERGE (tu)-[:PART_OF]->(o) ' \
+                            'MERGE (tu)-[:HAS_NAME]->(t:Term {text: {name}}) ' \
+                            'RETURN tu'
+                    res_tus = self._execute_write(
+                        query, organism=self.ecoli_node._id, regid=regid,
+                        name=name, properties=properties)
+
+                    if len(res_tus.data) > 1:
+                        problem += 1
+                        logging.warning("There are %d nodes for a TU with "
+                                        "RegulonDB ID:%s! They were skipped!"
+                                        % (len(res_tus.data), regid))
+                        continue
+                    tu = res_tus.data[0].values[0]
+                else:
+                    tu, term, rel_org, rel_term = self.connection.create(
+                        node(properties),
+                        node({'text': name}),
+                        rel(0, 'PART_OF', self.ecoli_node),
+                        rel(0, 'HAS_NAME', 1))
+                    tu.add_labels('TU', 'BioEntity', 'DNA')
+                    term.add_labels('Term')
                 created += 1
 
                 # creating a relation (:TU)-[:CONTAINS]->(:Promoter)
                 query = 'MATCH (t:Term {text: "%s"})<-[:HAS_NAME]-' \
                         '(p:Promoter)-[:PART_OF]->(o:Organism {name: "%s"}) ' \
-                        'RETURN p' % (pro, self.ecoli_name)
-                res = neo4j.CypherQuery(self.connection, query)
-                res_nodes = res.execute()
+                        'RETURN p'
+                res_nodes = self._execute(query, (pro, self.ecoli_name))
 
                 if not res_nodes:
                     logging.warning("There is no node for a promoter with name "
@@ -244,6 +692,13 @@ class RegulonDB():
                     logging.warning("There are %d nodes for a promoter with "
                                     "name %s! They were skipped!"
                                     % (len(res_nodes), pro))
+                # later rows find TUs through this relation, so it is not queued
+                elif self.idempotent:
+                    query = 'START tu=node({tu}), p=node({promoter}) ' \
+                            'MERGE (tu)-[:CONTAINS]->(p)'
+                    self._execute_write(
+                        query, tu=tu._id,
+                        promoter=res_nodes.data[0].values[0]._id)
                 else:
                     rel_promoter = self.connection.create(
                         rel(tu, 'CONTAINS', res_nodes.data[0].values[0]))
@@ -276,16 +731,17 @@ class RegulonDB():
                                 "%s! They were skipped!"
                                 % (len(operon_node), operon))
             else:
-                rel_operon = self.connection.create(
-                    rel(operon_node[0], 'CONTAINS', tu))
-
+                self._relate(operon_node[0], 'CONTAINS', tu)
 
+        self._flush()
         logging.info("%d TUs were updated and connected to operons!" % updated)
-        logging.info("%d TUs were created and connected to operons!" % created)
+        logging.info("%d TUs were %s and connected to operons!"
+                     % (created, 'merged' if self.idempotent else 'created'))
 
         if problem > 0:
             logging.warning("There were problems with %d TUs." % problem)
 
+    @profiled
     def create_update_terminators(self):
         f = open(self.directory + 'Terminators.txt', 'r')
         data = f.readlines()
@@ -303,9 +759,9 @@ class RegulonDB():
 
             query = 'MATCH (ch:Chromosome {name: "%s"})<-[:PART_OF]-' \
                     '(t:Terminator {start: %d, end: %d, strand: "%s"}) ' \
-                    'RETURN t' % (self.chro_name, start, end, strand)
-            res = neo4j.CypherQuery(self.connection, query)
-            res_nodes = res.execute()
+                    'RETURN t'
+            res_nodes = self._execute(query,
+                                      (self.chro_name, start, end, strand))
 
             # creating terminator
             if not res_nodes:
@@ -337,6 +793,7 @@ class RegulonDB():
             rel_tu = self.relation_with_tu(tu, terminator)
             problem = problem + rel_tu
 
+        self._flush()
         logging.info('%d terminators were updated!' % updated)
         logging.info('%d terminators were created!' % created)
 
@@ -344,64 +801,90 @@ class RegulonDB():
             logging.warning('There were problems with %d terminators.' % problem)
 
 
-    def create_update_genes_and_products(self):
+    @profiled
+    def create_update_genes_and_products(self, workers=1, region_size=100000):
+        if not isinstance(region_size, int) or region_size < 1:
+            raise ValueError('The region_size argument must be a positive '
+                             'integer!')
+
         # creating a sRNA genes names list
-        f = open(self.directory + 'sRNA genes.txt', 'r')
-        data = f.readlines()
-        f.close()
-        srna_genes = [line.split('\t')[1] for line in data if line[0] != '#']
+        srna_genes = [line.split('\t')[1]
+                      for line in self._read_lines('sRNA genes.txt')]
+        rows = [line.split('\t')
+                for line in self._read_lines('All gene products.txt')]
+
+        if workers > 1:
+            # genes are matched by location, so rows of different strands
+            # or chromosome regions never touch the same gene
+            key = lambda row: (row[5], int(row[3] or 0) // region_size)
+            updated, created, problem = self._run_partitioned(
+                '_update_genes_and_products', rows, key, workers,
+                {'srna_genes': srna_genes})
+        else:
+            updated, created, problem = self._update_genes_and_products(
+                rows, srna_genes)
 
-        f = open(self.directory + 'All gene products.txt', 'r')
-        data = f.readlines()
-        f.close()
+        logging.info('%d genes were updated!' % updated)
+        logging.info('%d genes were created!' % created)
+
+        if problem > 0:
+              logging.warning('There were problems with %d genes.' % problem)
+
+    def _update_genes_and_products(self, rows, srna_genes, deferred=None):
         updated, created, problem = [0]*3
 
-        for line in data:
-            if line[0] == '#':
-                continue
+        # genes created here by location; in a worker their PART_OF
+        # relations are deferred, so the queries below cannot find them
+        located = {}
+
+        for row in rows:
             regid, name, bcode, start, end, strand, product, evidence, \
-            pmid = line.split('\t')
+            pmid = row
             start, end = [int(start), int(end)]
 
             ### testing
             if '' in [regid, strand, start, end] or 0 in [start, end]:
                 continue
 
+            if (start, end, strand) in located:
+                gene, product = located[(start, end, strand)]
+                update_source_property(gene)
+                update_source_property(product)
+                updated += 1
+                continue
+
             query = 'MATCH (ch:Chromosome {name: "%s"})<-[:PART_OF]-' \
                     '(g:Gene {start: %d, end: %d, strand: "%s"})-' \
                     '[:ENCODES]->(p) ' \
-                    'RETURN g, p' % (self.chro_name, start, end, strand)
-            res = neo4j.CypherQuery(self.connection, query)
-            res_nodes = res.execute()
+                    'RETURN g, p'
+            res_nodes = self._execute(query,
+                                      (self.chro_name, start, end, strand))
 
 
             if not res_nodes:
                 # is it a gene without a product?
                 query = 'MATCH (ch:Chromosome {name: "%s"})<-[:PART_OF]-' \
                         '(g:Gene {start: %d, end: %d, strand: "%s"}) ' \
-                        'RETURN g' % (self.chro_name, start, end, strand)
-                res = neo4j.CypherQuery(self.connection, query)
-                res_nodes = res.execute()
+                        'RETURN g'
+                res_nodes = self._execute(query,
+                                          (self.chro_name, start, end, strand))
 
                 # creting a gene and its product
                 if not res_nodes:
-                    gene, term1, product, term2, rel_org1, \
-                    rel_org2, rel_chro, rel_term1, rel_term2, \
-                    rel_prod = self.connection.create(
-                        node({'name': name, 'evidence': evidence,
-                              'start': start, 'end': end,
-                              'strand': strand, 'bcode': bcode,
-                              'product': product, 'Reg_id': regid,
-                              'source': 'RegulonDB'}),
-                        node({'text': name}),
-                        node({'name': product, 'source': 'RegulonDB'}),
-                        node({'text': product}),
-                        rel(0, 'PART_OF', self.ecoli_node),
-                        rel(2, 'PART_OF', self.ecoli_node),
-                        rel(0, 'PART_OF', self.chro_node),
-                        rel(0, 'HAS_NAME', 1),
-                        rel(2, 'HAS_NAME', 3),
-                        rel(0, 'ENCODES', 2))
+                    gene, term1, product, term2 = self._create(
+                        [node({'name': name, 'evidence': evidence,
+                               'start': start, 'end': end,
+                               'strand': strand, 'bcode': bcode,
+                               'product': product, 'Reg_id': regid,
+                               'source': 'RegulonDB'}),
+                         node({'text': name}),
+                         node({'name': product, 'source': 'RegulonDB'}),
+                         node({'text': product}),
+                         rel(0, 'HAS_NAME', 1),
+                         rel(2, 'HAS_NAME', 3),
+                         rel(0, 'ENCODES', 2)],
+                        [(0, 'organism'), (2, 'organism'), (0, 'chromosome')],
+                        deferred)[:4]
 
 
                     gene.add_labels('Gene', 'BioEntity', 'Feature', 'DNA')
@@ -416,13 +899,12 @@ class RegulonDB():
                     gene.update_properties({'bcode': bcode,
                                             'Reg_id': regid,
                                             'evidence': evidence})
-                    product, term, rel_term, rel_chro, \
-                    rel_prod = self.connection.create(
-                        node({'name': product, 'source': 'RegulonDB'}),
-                        node({'text': product}),
-                        rel(0, 'HAS_NAME', 1),
-                        rel(0, 'PART_OF', self.ecoli_node),
-                        rel(gene, 'ENCODES', 0))
+                    product, term = self._create(
+                        [node({'name': product, 'source': 'RegulonDB'}),
+                         node({'text': product}),
+                         rel(0, 'HAS_NAME', 1),
+                         rel(gene, 'ENCODES', 0)],
+                        [(0, 'organism')], deferred)[:2]
                     term.add_labels('Term')
                     update_source_property(gene)
                     updated += 1
@@ -440,6 +922,7 @@ class RegulonDB():
                     product.add_labels('Polypeptide', 'Peptide', 'BioEntity')
                 else:
                     product.add_labels('sRNA', 'RNA', 'BioEntity')
+                located[(start, end, strand)] = (gene, product)
 
             elif len(res_nodes.data) == 1:
                 gene = res_nodes.data[0].values[0]
@@ -454,28 +937,51 @@ class RegulonDB():
                                 % (len(res_nodes.data), start, end, strand))
                 problem += 1
 
+        return updated, created, problem
 
-        logging.info('%d genes were updated!' % updated)
-        logging.info('%d genes were created!' % created)
+    @profiled
+    def create_update_BSs(self, workers=1):
+        rows = [line.split('\t')
+                for line in self._read_lines('TF binding sites.txt')]
+        registry = self._tf_registry(rows)
+
+        if workers > 1:
+            # a TU has a single promoter, so rows with different promoters
+            # never touch the same TU, promoter or binding site
+            key = lambda row: row[9]
+            updated, created, problem = self._run_partitioned(
+                '_update_BSs', rows, key, workers, {}, registry)
+        else:
+            updated, created, problem = self._update_BSs(rows, registry)
+
+        logging.info('%d BSs were updated!' % updated)
+        logging.info('%d BSs were created!' % created)
 
         if problem > 0:
-              logging.warning('There were problems with %d genes.' % problem)
+              logging.warning('There were problems with %d BSs.' % problem)
 
-    def create_update_BSs(self):
-        f = open(self.directory + 'TF binding sites.txt', 'r')
-        data = f.readlines()
-        f.close()
-        created, updated, problem = [0]*3
+    def _valid_bs_row(self, row):
+        """
+        Checks that a row of 'TF binding sites.txt' has all the fields the
+        binding site stage needs.
+        """
+        regid, name, site_id, start, end, strand, inter_id, tu_name, \
+        effect, pro, center, seq, evidence = row
 
-        for line in data:
-            if line[0] == '#':
-                continue
+        if '' in [regid, strand, start, end, center] or 0 in [start, end]:
+            return False
+        return True
 
+    def _update_BSs(self, rows, registry=None, deferred=None):
+        updated, created, problem = [0]*3
+        links = []
+
+        for row in rows:
             regid, name, site_id, start, end, strand, inter_id, tu_name, \
-            effect, pro, center, seq, evidence = line.split('\t')
+            effect, pro, center, seq, evidence = row
 
             ### testing
-            if '' in [regid, strand, start, end, center] or 0 in [start, end]:
+            if not self._valid_bs_row(row):
                 continue
 
             start, end, center = [int(start), int(end), float(center)]
@@ -484,9 +990,8 @@ class RegulonDB():
                     '(tu:TU)-[:HAS_NAME]-(t1:Term {text: "%s"}), ' \
                     '(tu)-[:CONTAINS]->(p:Promoter)-[:HAS_NAME]-' \
                     '(t2:Term {text: "%s"}) ' \
-                    'RETURN p, tu' % (self.ecoli_name, tu_name, pro)
-            res = neo4j.CypherQuery(self.connection, query)
-            res_nodes = res.execute()
+                    'RETURN p, tu'
+            res_nodes = self._execute(query, (self.ecoli_name, tu_name, pro))
 
             if not res_nodes:
                 problem += 1
@@ -510,21 +1015,19 @@ class RegulonDB():
                     '(t2:Term {text: "%s"}), ' \
                     '(tu)-[:CONTAINS]->(bs:BS {strand: "%s"}) ' \
                     'WHERE bs.start=%d OR bs.start=%d AND bs.end=%d ' \
-                    'RETURN bs' \
-                    % (self.ecoli_name, tu_name, pro, strand, site_mid,
-                       start, end)
-            res = neo4j.CypherQuery(self.connection, query)
-            res_nodes = res.execute()
+                    'RETURN bs'
+            res_nodes = self._execute(query, (self.ecoli_name, tu_name, pro,
+                                              strand, site_mid, start, end))
 
             # creating BS
             if not res_nodes:
-                bs, rel_chr, rel_tu = self.connection.create(
-                    node({'start': start, 'end': end,
-                          'strand': strand, 'seq': seq,
-                          'evidence': evidence, 'Reg_id': site_id,
-                          'source': 'RegulonDB', 'center': center}),
-                    rel(0, 'PART_OF', self.chro_node),
-                    rel(tu, 'CONTAINS', 0))
+                bs = self._create(
+                    [node({'start': start, 'end': end,
+                           'strand': strand, 'seq': seq,
+                           'evidence': evidence, 'Reg_id': site_id,
+                           'source': 'RegulonDB', 'center': center}),
+                     rel(tu, 'CONTAINS', 0)],
+                    [(0, 'chromosome')], deferred)[0]
                 bs.add_labels('BS', 'Feature', 'DNA')
                 created += 1
 
@@ -546,43 +1049,47 @@ class RegulonDB():
                 continue
 
 
+            # regulation events are merged on their interaction IDs, so
+            # only the BS of a row without one is kept
+            if self.idempotent and inter_id == '':
+                continue
+
             # creating relations
             # (:TF)-[:PARTICIPATES_IN]->(:TranscriptionRegulation)
-            transreg, rel_bs_transreg, rel_pro = self.connection.create(
-                node({'Reg_id': inter_id, 'source': 'RegulonDB'}),
-                rel(bs, 'PARTICIPATES_IN', 0),
-                rel(0, tf_effect(effect), promoter))
-            transreg.add_labels('TranscriptionRegulation',
-                                'RegulationEvent', 'Binding')
+            if self.idempotent:
+                query = 'START bs=node({bs}), p=node({promoter}) ' \
+                        'MERGE (tr:TranscriptionRegulation {Reg_id: {regid}}) ' \
+                        'ON CREATE SET tr.source = "RegulonDB" ' \
+                        'SET tr:RegulationEvent:Binding ' \
+                        'MERGE (bs)-[:PARTICIPATES_IN]->(tr) ' \
+                        'MERGE (tr)-[:%s]->(p)' % tf_effect(effect)
+                self._queue(query, {'bs': bs._id, 'promoter': promoter._id,
+                                    'regid': inter_id})
+                transreg = inter_id
+            else:
+                transreg, rel_bs_transreg, rel_pro = self.connection.create(
+                    node({'Reg_id': inter_id, 'source': 'RegulonDB'}),
+                    rel(bs, 'PARTICIPATES_IN', 0),
+                    rel(0, tf_effect(effect), promoter))
+                transreg.add_labels('TranscriptionRegulation',
+                                    'RegulationEvent', 'Binding')
+                transreg = transreg._id
 
             # creating relations
             # (:Protein)-[:PARTICIPATES_IN]->(:TranscriptionRegulation)
-            protein_node = list(self.connection.find('Protein', 'Reg_id', regid))
-
-            if not protein_node:
-                protein_node = self.connection.create(
-                    node({'Reg_id': regid, 'name': name,
-                          'source': 'RegulonDB'}))
-                protein_node[0].add_labels('Protein', 'BioEntity')
-
-            # if there are proteins-duplicates
-            elif len(protein_node) > 1:
-                logging.warning("There are %d nodes for a protein with name %s!"
-                                "They were skipped!" % (len(protein_node), name))
-                continue
+            # proteins are shared by partitions, so workers defer them at
+            # once to return them even if the partition fails later
+            if deferred is not None:
+                deferred.append(('PARTICIPATES_IN', regid, transreg))
             else:
-                #protein_node = protein_node[0]
-                pass
+                links.append((regid, transreg))
 
-            rel_protein = self.connection.create(
-                rel(protein_node[0], 'PARTICIPATES_IN', transreg))
-
-        logging.info('%d BSs were updated!' % updated)
-        logging.info('%d BSs were created!' % created)
-
-        if problem > 0:
-              logging.warning('There were problems with %d BSs.' % problem)
+        self._flush()
+        if deferred is None:
+            self._link_proteins(registry, links)
+        return updated, created, problem
 
+    @profiled
     def links_genes_tus(self):
         f = open(self.directory + 'Transcription Units.txt', 'r')
         data = f.readlines()
@@ -590,8 +1097,7 @@ class RegulonDB():
 
         # searching for all genes without connection with TUs
         query = 'MATCH (g:Gene) WHERE NOT (g:Gene)<-[:CONTAINS]-(:TU) RETURN g'
-        res = neo4j.CypherQuery(self.connection, query)
-        res_nodes = res.execute()
+        res_nodes = self._execute(query)
 
         if not res_nodes:
             pass
@@ -617,10 +1123,12 @@ class RegulonDB():
                                         "RegulonDB ID:%s! They were skipped!"
                                         % (len(tu_node), tu_regid))
                     else:
-                        rel_tu_gene = self.connection.create(
-                            rel(tu_node[0], 'CONTAINS', gene))
+                        self._relate(tu_node[0], 'CONTAINS', gene)
+
+        self._flush()
 
 
+    @profiled
     def create_RBSs(self):
         f = open(self.directory + 'RBSs.txt', 'r')
         data = f.readlines()
@@ -642,9 +1150,8 @@ class RegulonDB():
 
             query = 'MATCH (o:Organism {name: "%s"})<-[:PART_OF]-' \
                     '(g:Gene {strand: "%s"})-[:HAS_NAME]-(t:Term {text: "%s"}) ' \
-                    'RETURN g' % (self.ecoli_name, strand, gene)
-            res = neo4j.CypherQuery(self.connection, query)
-            res_nodes = res.execute()
+                    'RETURN g'
+            res_nodes = self._execute(query, (self.ecoli_name, strand, gene))
 
             if not res_nodes:
                 continue
@@ -659,18 +1166,35 @@ class RegulonDB():
                 i = genes.index(min(genes))
                 g = res_nodes.data[i].values[0]
 
-            rbs, rel_chr, rel_gene = self.connection.create(
-                node({'evidence': evidence, 'Reg_id': regid,
-                      'source': 'RegulonDB', 'start': start,
-                      'end': end, 'strand': strand,
-                      'seq': seq, 'center_from_tss': center}),
-                rel(0, 'PART_OF', self.chro_node),
-                rel(g, 'CONTAINS', 0))
-            rbs.add_labels('RBS', 'Feature')
+            properties = {'evidence': evidence, 'Reg_id': regid,
+                          'source': 'RegulonDB', 'start': start,
+                          'end': end, 'strand': strand,
+                          'seq': seq, 'center_from_tss': center}
+
+            # RBSs are keyed on their RegulonDB IDs
+            if self.idempotent:
+                query = 'START g=node({gene}), ch=node({chromosome}) ' \
+                        'MERGE (rbs:RBS {Reg_id: {regid}}) ' \
+                        'SET rbs = {properties}, rbs:Feature ' \
+                        'MERGE (rbs)-[:PART_OF]->(ch) ' \
+                        'MERGE (g)-[:CONTAINS]->(rbs)'
+                self._queue(query, {'gene': g._id,
+                                    'chromosome': self.chro_node._id,
+                                    'regid': regid,
+                                    'properties': properties})
+            else:
+                rbs, rel_chr, rel_gene = self.connection.create(
+                    node(properties),
+                    rel(0, 'PART_OF', self.chro_node),
+                    rel(g, 'CONTAINS', 0))
+                rbs.add_labels('RBS', 'Feature')
             created += 1
 
-        logging.info('%d RBSs were created!' % created)
+        self._flush()
+        logging.info('%d RBSs were %s!'
+                     % (created, 'merged' if self.idempotent else 'created'))
 
+    @profiled
     def create_3_5_ends(self):
         f = open(self.directory + "5' and 3' UTR sequence of TUs.txt", 'r')
         data = f.readlines()
@@ -692,9 +1216,8 @@ class RegulonDB():
                     '(p:Promoter {tss: %d})-[:HAS_NAME]->' \
                     '(t1:Term {text: "%s"}), ' \
                     '(p)--(tu:TU) ' \
-                    'RETURN p, tu' % (self.ecoli_name, int(tss), pro)
-            res = neo4j.CypherQuery(self.connection, query)
-            res_nodes = res.execute()
+                    'RETURN p, tu'
+            res_nodes = self._execute(query, (self.ecoli_name, int(tss), pro))
 
             if not res_nodes:
                 continue
@@ -702,28 +1225,39 @@ class RegulonDB():
                 promoter = res_nodes.data[0].values[0]
                 TU = res_nodes.data[0].values[1]
 
-                if loc5 != '':
-                    start, end = [int(x) for x in loc5.split('-')]
-                    end5, rel_chr, rel_pro, rel_TU = self.connection.create(
-                        node({'source': 'RegulonDB', 'start': start,
-                          'end': end, 'strand': strand,
-                          'seq': seq5}),
-                        rel(0, 'PART_OF', self.chro_node),
-                        rel(0, 'IS_ASSOCIATED_WITH', promoter),
-                        rel(TU, 'CONTAINS', 0))
-                    end5.add_labels("5'UTR", 'Feature')
-                    created += 1
-
-                if loc3 != '':
-                    start, end = [int(x) for x in loc3.split('-')]
-                    end3, rel_chr, rel_pro, rel_TU = self.connection.create(
-                        node({'source': 'RegulonDB', 'start': start,
-                          'end': end, 'strand': strand,
-                          'seq': seq3}),
-                        rel(0, 'PART_OF', self.chro_node),
-                        rel(0, 'IS_ASSOCIATED_WITH', promoter),
-                        rel(TU, 'CONTAINS', 0))
-                    end3.add_labels("3'UTR", 'Feature')
+                for label, loc, seq in [("5'UTR", loc5, seq5),
+                                        ("3'UTR", loc3, seq3)]:
+                    if loc == '':
+                        continue
+                    start, end = [int(x) for x in loc.split('-')]
+
+                    # UTRs are keyed on their TU and location, so every
+                    # TU keeps its own UTR as in a non-idempotent load
+                    if self.idempotent:
+                        query = 'START p=node({promoter}), tu=node({tu}), ' \
+                                'ch=node({chromosome}) ' \
+                                'MERGE (tu)-[:CONTAINS]->(utr:`%s` ' \
+                                '{start: {start}, end: {end}, ' \
+                                'strand: {strand}}) ' \
+                                'SET utr.source = "RegulonDB", ' \
+                                'utr.seq = {seq}, utr:Feature ' \
+                                'MERGE (utr)-[:PART_OF]->(ch) ' \
+                                'MERGE (utr)-[:IS_ASSOCIATED_WITH]->(p)' \
+                                % label
+                        self._queue(query, {'promoter': promoter._id,
+                                            'tu': TU._id,
+                                            'chromosome': self.chro_node._id,
+                                            'start': start, 'end': end,
+                                            'strand': strand, 'seq': seq})
+                    else:
+                        utr, rel_chr, rel_pro, rel_TU = self.connection.create(
+                            node({'source': 'RegulonDB', 'start': start,
+                                  'end': end, 'strand': strand,
+                                  'seq': seq}),
+                            rel(0, 'PART_OF', self.chro_node),
+                            rel(0, 'IS_ASSOCIATED_WITH', promoter),
+                            rel(TU, 'CONTAINS', 0))
+                        utr.add_labels(label, 'Feature')
                     created += 1
             else:
                 logging.warning("There are %d nodes for a promoter with "
@@ -731,4 +1265,6 @@ class RegulonDB():
                                 "It was skipped!"
                                 % (len(res_nodes.data), pro, tu))
 
-        logging.info("%d 5'UTRs and 3'UTRs were created!" % created)
\ No newline at end of file
+        self._flush()
+        logging.info("%d 5'UTRs and 3'UTRs were %s!"
+                     % (created, 'merged' if self.idempotent else 'created'))
\ No newline at end of file